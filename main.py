@@ -1,24 +1,34 @@
 import os
-from dotenv import load_dotenv
 import re
-from fastapi import FastAPI, HTTPException
-import concurrent.futures
-from pydantic import BaseModel
-from typing import Dict, List, Tuple, Any
+import asyncio
+import time
+from dotenv import load_dotenv
+import httpx
+import msgspec
+import orjson
+import redis.asyncio as redis
+import ahocorasick
+from functools import lru_cache
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from typing import AsyncIterator, Dict, Iterable, List, Tuple, Any
 from google import genai
 from google.genai import types
-import re as _re
 # Load environment variables from .env file
 load_dotenv()
 
 # === Constants ===
 # HTTP STATUS
 HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_UNPROCESSABLE = 422
 HTTP_STATUS_INTERNAL_ERROR = 500
 
 # CHAT LIMIT
 MAX_CHAT_HISTORY = 20  # Number of messages to keep in context
 MAX_TOTAL_CONVERSATION = 100  # Max messages per chat
+CHAT_TIMEOUT = 25.0  # Seconds before a chat request is abandoned
+CHAT_TTL_SECONDS = int(os.getenv("CHAT_TTL_SECONDS", 7 * 24 * 60 * 60))  # Chats untouched for this long are evicted from Redis
+MAX_CHATS_PER_USER = int(os.getenv("MAX_CHATS_PER_USER", 1000))  # Least recently used chats beyond this are evicted
 MODEL_TOP_TIER_THRESHOLD = 10
 MODEL_MEDIUM_TIER_THRESHOLD = 7
 
@@ -27,6 +37,7 @@ TOKEN_THRESHOLD_PRO = 3000
 WEIGHT_SMALL = 2
 WEIGHT_MEDIUM = 3
 WEIGHT_HARD = 5
+SCORE_CACHE_MAX_LENGTH = 256  # Only messages up to this many characters are kept in the score cache
 
 app = FastAPI()
 
@@ -35,66 +46,146 @@ app = FastAPI()
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 if not gemini_api_key:
     raise RuntimeError("GEMINI_API_KEY environment variable not set.")
-client = genai.Client(api_key=gemini_api_key)
-
-
-class Message(BaseModel):
+# Conversation state lives in Redis so several workers can serve the same chats
+redis_client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True)
+
+# One client for the whole process: calls share an HTTP/2 connection pool with keep-alive,
+# so TLS handshakes are amortized across requests instead of paid per Gemini call
+GEMINI_CLIENT_ARGS = {
+    "http2": True,
+    "limits": httpx.Limits(max_connections=256, max_keepalive_connections=128, keepalive_expiry=60),
+}
+client = genai.Client(
+    api_key=gemini_api_key,
+    http_options=types.HttpOptions(
+        timeout=30000,  # milliseconds
+        client_args=GEMINI_CLIENT_ARGS,
+        async_client_args=GEMINI_CLIENT_ARGS,
+    ),
+)
+
+
+# Leading bullets, numbering and whitespace the model sometimes puts before a title
+TITLE_CLEAN = re.compile(r"^[\-\*\d\.\s]*")
+# Triple backtick code blocks (with or without language)
+CODE_BLOCK_PATTERN = re.compile(r"```([a-zA-Z0-9]*)\n([\s\S]*?)```")
+
+
+class Message(msgspec.Struct):
     role: str  # 'user' or 'assistant'
     content: str
 
 
-class ChatRequest(BaseModel):
+class ChatRequest(msgspec.Struct):
     user_id: str
     chat_id: str
     message: Message
 
 
+async def decode_chat_request(request: Request) -> ChatRequest:
+    """Decode and validate the /chat body with msgspec instead of pydantic."""
+    try:
+        return msgspec.json.decode(await request.body(), type=ChatRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=HTTP_STATUS_UNPROCESSABLE, detail=str(e))
+
+
+def inline_json_schema(struct_type: Any) -> Dict[str, Any]:
+    """msgspec JSON schema with its $defs inlined, since OpenAPI resolves "#/$defs/..." against the whole document."""
+    schema = msgspec.json.schema(struct_type)
+    defs = schema.pop("$defs", {})
+
+    def resolve(node: Any) -> Any:
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(defs[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+
+    return resolve(schema)
+
+
+# The body is decoded by msgspec, so FastAPI cannot infer it: document it for /docs by hand
+CHAT_REQUEST_BODY = {
+    "content": {"application/json": {"schema": inline_json_schema(ChatRequest)}},
+    "required": True,
+}
+CHAT_STREAM_RESPONSE = {
+    "description": (
+        'Server-sent events: {"delta": text} chunks while Gemini generates, then one final '
+        '{"response", "title", "model", "citation"} event. A failure after streaming started '
+        'ends the stream with an {"error": message} event instead.'
+    ),
+    "content": {"text/event-stream": {"schema": {"type": "string"}}},
+}
+
+
 
 
-# Model routing constants
+# Model routing constants (literals, lowercased at load and matched against lowercased content)
 HARD_KEYWORDS = [
-    r"derivative", r"integral",  r"big-?o", r"complexity", r"algorithm", r"algoritma",r"mathematical",
-    r"dynamic programming", r"regex", r"sql",  r"stack trace", r"panic", r"traceback",  r"recursion", r"algorithm", r"theorem", r"bukti", r"turunan", r"integral", r"induksi",
-    r"np[-\s]?sulit", r"kompleksitas", r"pemrograman dinamis", r"jejak tumpukan", r"jejak kesalahan", r"jejak error", r"jejak",
-    r"algoritma", r"teorema", r"persamaan", r"matematika", r"logika", r"berpikir keras", r"pikir keras", r"buktikan", r"soal sulit",
-    r"tantangan", r"uji", r"uji coba", r"uji hipotesis", r"prima", r"prime"
+    "derivative", "integral",  "big-o", "bigo", "complexity", "algorithm", "algoritma", "mathematical",
+    "dynamic programming", "regex", "sql",  "stack trace", "panic", "traceback",  "recursion", "theorem", "bukti", "turunan", "induksi",
+    "np-sulit", "np sulit", "npsulit", "kompleksitas", "pemrograman dinamis", "jejak tumpukan", "jejak kesalahan", "jejak error", "jejak",
+    "teorema", "persamaan", "matematika", "logika", "berpikir keras", "pikir keras", "buktikan", "soal sulit",
+    "tantangan", "uji", "uji coba", "uji hipotesis", "prima", "prime"
 ]
 MEDIUM_KEYWORDS = [
-    r"apa itu", r"jelaskan", r"analisa", r"penjelasan", r"mengapa", r"kenapa", r"sulit", r"tantangan", r"perbaiki", r"kesalahan",
-    r"masalah", r"solusi", r"langkah", r"cara", r"bagaimana", r"penyebab", r"penyelesaian" 
+    "apa itu", "jelaskan", "analisa", "penjelasan", "mengapa", "kenapa", "sulit", "tantangan", "perbaiki", "kesalahan",
+    "masalah", "solusi", "langkah", "cara", "bagaimana", "penyebab", "penyelesaian"
 ]
-HARD_PATTERN = re.compile("|".join(HARD_KEYWORDS), re.IGNORECASE)
-MEDIUM_PATTERN = re.compile("|".join(MEDIUM_KEYWORDS), re.IGNORECASE)
+
+
+def _build_automaton(keywords: List[str]) -> ahocorasick.Automaton:
+    """Build an Aho-Corasick automaton that finds all keywords in one pass."""
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        # Content is lowercased once per request, so matching itself never has to fold case
+        keyword = keyword.lower()
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
+
+HARD_AUTOMATON = _build_automaton(HARD_KEYWORDS)
+MEDIUM_AUTOMATON = _build_automaton(MEDIUM_KEYWORDS)
+
+def _score_text(content: str) -> int:
+    """Weighted complexity score of a message."""
+    score = 1  # Start with a base score of 1
+    lowered = content.lower()
+    # Hard keywords: +5 each (iter_long counts non-overlapping longest matches, like the old regex)
+    score += WEIGHT_HARD * sum(1 for _ in HARD_AUTOMATON.iter_long(lowered))
+    # Medium keywords: +3 each
+    score += WEIGHT_MEDIUM * sum(1 for _ in MEDIUM_AUTOMATON.iter_long(lowered))
+    # Question marks: +2 each
+    score += WEIGHT_SMALL * content.count('?')
+    return score
+
+
+# Retries and short commands repeat, long messages rarely do and would make the cache hold arbitrary amounts of text
+_cached_score_text = lru_cache(maxsize=8192)(_score_text)
+
 
 # simple model routing, but current method is not suitable for production
 # context on previous message maybe lost, potential solution for production
 # 1. distilation using higher model
 # 2. store message fact to make lower model smarter, also consistency check for lower model if answer is same as fact
 # 3. transform question into statement or smaller question to make lower model easier to process
-def select_model(content: str, conversation: str) -> str:
+def select_model(content: str, conversation: Iterable[str]) -> str:
     """Select Gemini model based on weighted content complexity."""
-    score = 1  # Start with a base score of 1
-    # Hard keywords: +5 each
-    score += WEIGHT_HARD * len(HARD_PATTERN.findall(content))
-    # Medium keywords: +3 each
-    score += WEIGHT_MEDIUM * len(MEDIUM_PATTERN.findall(content))
-    # Question marks: +2 each
-    score += WEIGHT_SMALL * content.count('?')
-    
-    # Convert conversation (list of Message) to a string prompt for token counting
+    score = _cached_score_text(content) if len(content) <= SCORE_CACHE_MAX_LENGTH else _score_text(content)
+
     # weighting for pro model is disabled because of potential token limit issues
     # sometimes, query get {'error': {'code': 500, 'message': 'An internal error has occurred. Please retry or report in https://developers.generativeai.google/guide/troubleshooting', 'status': 'INTERNAL'}} 
-    # if isinstance(conversation, list):
-    #     prompt = ""
-    #     for m in conversation:
-    #         prompt += f"{m.role}: {m.content}\n"
-    #     estimatedToken = client.models.count_tokens(model="gemini-2.5-flash-lite", contents=prompt)
-    # else:
-    #     estimatedToken = client.models.count_tokens(conversation)
-    # token_count = estimatedToken.total_tokens if hasattr(estimatedToken, 'total_tokens') else int(estimatedToken)
-    
+    # when enabled, estimate the conversation size locally (~4 characters per token) instead of a count_tokens round-trip,
+    # conversation holds the rendered "role: content" lines
+    # estimatedToken = sum(max(1, len(line) // 4) for line in conversation)
+
     # scoring base model routing
-    # if score >= MODEL_TOP_TIER_THRESHOLD or token_count > TOKEN_THRESHOLD_PRO:
+    # if score >= MODEL_TOP_TIER_THRESHOLD or estimatedToken > TOKEN_THRESHOLD_PRO:
     #     return "gemini-2.5-pro"
     # elif score >= MODEL_MEDIUM_TIER_THRESHOLD:
     #     return "gemini-2.5-flash"
@@ -105,16 +196,80 @@ def select_model(content: str, conversation: str) -> str:
     else:
         return "gemini-2.5-flash-lite"
 
-# In-memory conversation storage: {(user_id, chat_id): [Message, ...]}
-conversations: Dict[Tuple[str, str], List[Message]] = {}
-# In-memory chat titles: {(user_id, chat_id): str}
-chat_titles: Dict[Tuple[str, str], str] = {}
+# Redis keys, every key expires CHAT_TTL_SECONDS after the chat was last used
+def _redis_key(prefix: str, *ids: str) -> str:
+    """Build a Redis key with the ids JSON-encoded, so ids containing ":" cannot collide."""
+    return f"{prefix}:{orjson.dumps(ids).decode()}"
+
+
+def history_key(user_id: str, chat_id: str) -> str:
+    """List of JSON {"role", "content"} messages, the full conversation."""
+    return _redis_key("hist", user_id, chat_id)
+
+
+def prompt_key(user_id: str, chat_id: str) -> str:
+    """List of "role: content\\n" lines rendered once per message, trimmed to MAX_CHAT_HISTORY."""
+    return _redis_key("prompt", user_id, chat_id)
+
+
+def chats_key(user_id: str) -> str:
+    """Sorted set of a user's chat_ids scored by last use, so listing chats does not scan the keyspace."""
+    return _redis_key("chats", user_id)
+
+
+def titles_key(user_id: str) -> str:
+    """Hash of chat_id -> title for a user."""
+    return _redis_key("titles", user_id)
+
+
+async def append_message(user_id: str, chat_id: str, role: str, content: str) -> List[str]:
+    """Append a message to the chat and return the current prompt window."""
+    hist, prompt = history_key(user_id, chat_id), prompt_key(user_id, chat_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(hist, orjson.dumps({"role": role, "content": content}))
+        pipe.rpush(prompt, f"{role}: {content}\n")
+        # LTRIM keeps the prompt window bounded without any read-modify-write on our side
+        pipe.ltrim(prompt, -MAX_CHAT_HISTORY, -1)
+        pipe.lrange(prompt, 0, -1)
+        pipe.zadd(chats_key(user_id), {chat_id: time.time()})
+        pipe.zcard(chats_key(user_id))
+        pipe.expire(hist, CHAT_TTL_SECONDS)
+        pipe.expire(prompt, CHAT_TTL_SECONDS)
+        pipe.expire(chats_key(user_id), CHAT_TTL_SECONDS)
+        pipe.expire(titles_key(user_id), CHAT_TTL_SECONDS)
+        results = await pipe.execute()
+    if results[5] > MAX_CHATS_PER_USER:
+        await evict_chats(user_id, results[5] - MAX_CHATS_PER_USER)
+    return results[3]
+
+
+async def touch_chat(user_id: str, chat_id: str) -> None:
+    """Mark a chat as recently used, pushing back its expiry and LRU eviction."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zadd(chats_key(user_id), {chat_id: time.time()}, xx=True)
+        pipe.expire(history_key(user_id, chat_id), CHAT_TTL_SECONDS)
+        pipe.expire(prompt_key(user_id, chat_id), CHAT_TTL_SECONDS)
+        pipe.expire(chats_key(user_id), CHAT_TTL_SECONDS)
+        pipe.expire(titles_key(user_id), CHAT_TTL_SECONDS)
+        await pipe.execute()
+
+
+async def evict_chats(user_id: str, count: int) -> None:
+    """Delete a user's count least recently used chats."""
+    evicted = [chat_id for chat_id, _ in await redis_client.zpopmin(chats_key(user_id), count)]
+    if not evicted:
+        return
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for chat_id in evicted:
+            pipe.delete(history_key(user_id, chat_id), prompt_key(user_id, chat_id))
+        pipe.hdel(titles_key(user_id), *evicted)
+        await pipe.execute()
 
 def wrap_code_blocks(text):
     if not isinstance(text, str):
         text = str(text) if text is not None else ""
     # Handle triple backtick code blocks (with or without language)
-    text = _re.sub(r"```([a-zA-Z0-9]*)\n([\s\S]*?)```", lambda m: f"{m.group(2).strip()}", text)
+    text = CODE_BLOCK_PATTERN.sub(lambda m: f"{m.group(2).strip()}", text)
     # Handle indented code blocks (4 spaces or tab)
     lines = text.split('\n')
     in_code = False
@@ -126,12 +281,12 @@ def wrap_code_blocks(text):
             in_code = True
         else:
             if in_code:
-                result_lines.append(f"{'\n'.join(code_lines)}")
+                result_lines.append("\n".join(code_lines))
                 code_lines = []
                 in_code = False
             result_lines.append(line)
     if in_code:
-        result_lines.append(f"{'\n'.join(code_lines)}")
+        result_lines.append("\n".join(code_lines))
     return '\n'.join(result_lines)
         
 def add_citations(response):
@@ -159,164 +314,253 @@ def add_citations(response):
     else:
         return ""
 
-@app.post("/chat")
-def chat_endpoint(request: ChatRequest) -> Dict[str, Any]:
-    def process_chat():
-        key = (request.user_id, request.chat_id)
-        # Get or create conversation history
-        history = conversations.setdefault(key, [])
+def candidate_parts(candidate) -> List[Tuple[str, str]]:
+    """Extract ("text" | "code" | "output", text) parts from a response candidate."""
+    found = []
+    for part in candidate.content.parts:
+        # Always keep natural language
+        if getattr(part, "text", None):
+            found.append(("text", part.text))
+
+        # Code and its execution result, shown only if Gemini intended it as part of the answer
+        if getattr(part, "executable_code", None):
+            found.append(("code", f"{part.executable_code.code}"))
+
+        if getattr(part, "code_execution_result", None):
+            if part.code_execution_result.output:
+                found.append(("output", f"Output: {part.code_execution_result.output}"))
+    return found
+
+
+def sse_event(payload: Dict[str, Any]) -> bytes:
+    return b"data: " + msgspec.json.encode(payload) + b"\n\n"
+
+
+async def iter_until(stream: AsyncIterator[Any], deadline: float) -> AsyncIterator[Any]:
+    """Iterate an async stream, raising asyncio.TimeoutError once the loop time passes deadline."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            item = await asyncio.wait_for(anext(stream), timeout=deadline - loop.time())
+        except StopAsyncIteration:
+            return
+        yield item
+
+
+@app.post(
+    "/chat",
+    response_class=StreamingResponse,
+    responses={200: CHAT_STREAM_RESPONSE},
+    openapi_extra={"requestBody": CHAT_REQUEST_BODY},
+)
+async def chat_endpoint(request: ChatRequest = Depends(decode_chat_request)) -> StreamingResponse:
+    """Stream the reply as server-sent events: {"delta": text} chunks, then the final result."""
+    async def process_chat():
+        user_id, chat_id = request.user_id, request.chat_id
+        # Get conversation size and title
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.llen(history_key(user_id, chat_id))
+            pipe.hget(titles_key(user_id), chat_id)
+            history_length, title = await pipe.execute()
+        if history_length == 0:
+            # Title left behind by an expired chat with the same chat_id
+            title = None
         # Enforce total conversation limit
-        if len(history) >= MAX_TOTAL_CONVERSATION:
-            return {
+        if history_length >= MAX_TOTAL_CONVERSATION:
+            yield sse_event({
                 "response": "Conversation limit is ended. Please start a new chat.",
-                "title": chat_titles.get(key),
+                "title": title,
                 "model": None
-            }
-
-        # Generate title for new conversation
-        if key not in chat_titles and len(history) == 0 and request.message.role == "user":
-            title_prompt = f"Generate a single, short, and concise title (max 5 words, no explanation) for this conversation: {request.message.content}"
-            title_response = client.models.generate_content(
-                model="gemini-2.5-flash-lite",
-                contents=title_prompt
-            )
-            # Sanitize: take only the first line, remove bullet/numbering, and trim to 5 words max
-            raw_title = title_response.candidates[0].content.parts[0].text.strip()
-            first_line = raw_title.split('\n')[0]
-            # Remove bullet points or numbering
-            first_line = first_line.lstrip('-*0123456789. ').strip()
-            # Limit to 5 words
-            words = first_line.split()
-            concise_title = ' '.join(words[:5])
-            chat_titles[key] = concise_title
-
-        # Append the new message
-        history.append(request.message)
-
-        # Prepare prompt for Gemini API (latest format expects a single string)
-        # Limit to the last MAX_CHAT_HISTORY messages (10 back-and-forth) for quicker and limit token input
-        limited_history = history[-MAX_CHAT_HISTORY:]
-        prompt = ""
-        for m in limited_history:
-            prompt += f"{m.role}: {m.content}\n"
+            })
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CHAT_TIMEOUT
+
+        # Generate title for new conversation, concurrently with the main reply below
+        title_task = None
+        try:
+            if title is None and history_length == 0 and request.message.role == "user":
+                title_prompt = f"Generate a single, short, and concise title (max 5 words, no explanation) for this conversation: {request.message.content}"
+                title_task = asyncio.create_task(client.aio.models.generate_content(
+                    model="gemini-2.5-flash-lite",
+                    contents=title_prompt
+                ))
+
+            # Append the new message
+            lines = await append_message(user_id, chat_id, request.message.role, request.message.content)
+
+            # Prepare prompt for Gemini API (latest format expects a single string)
+            # Limit to the last MAX_CHAT_HISTORY messages (10 back-and-forth) for quicker and limit token input,
+            # Redis already trimmed the window so no slicing is needed
+            prompt = "".join(lines)
        
-        config = types.GenerateContentConfig(
-            tools=[
-                types.Tool(code_execution=types.ToolCodeExecution),
-                types.Tool(google_search=types.GoogleSearch())
-            ],
-            system_instruction="You are a helpful assistant. Use Google Search if needed to ground your answers and cite sources with [number] where relevant. Use Code execution tool only for code-related queries and complex math, do not show internal tool in response if it being used"
-        )
-
-        # Select model based on content complexity
-        model_name = select_model(request.message.content, history)
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt,
-            config=config,
-        )
-
-        # Add assistant's reply to history
-        # Safely extract text from response, handling different response structures
-        assistant_reply = ""
-        content_parts = []
-        debug = ""
-        if response.candidates and len(response.candidates) > 0:
-            debug += "1"
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts'):
-                debug += "2"
-                parts = candidate.content.parts
-                if parts and len(parts) > 0:
-                    debug += "3"
-                    for part in parts:
-                        # Always keep natural language
-                        if getattr(part, "text", None):
-                            content_parts.append(part.text)
-
-                        # Show code only if Gemini intended it as part of the answer
-                        if getattr(part, "executable_code", None):
-                            if candidate.finish_reason == "STOP":  # user-facing
-                                content_parts.append(f"{part.executable_code.code}")
-                            # else: skip (tool-only, like search)
-
-                        # Show code execution result only if it’s relevant
-                        if getattr(part, "code_execution_result", None):
-                            if part.code_execution_result.output:
-                                if candidate.finish_reason == "STOP":
-                                    content_parts.append(
-                                        f"Output: {part.code_execution_result.output}"
-                                    )
-                                # else skip (internal tool use)
-
-        assistant_reply = "".join(content_parts)
+            config = types.GenerateContentConfig(
+                tools=[
+                    types.Tool(code_execution=types.ToolCodeExecution),
+                    types.Tool(google_search=types.GoogleSearch())
+                ],
+                system_instruction="You are a helpful assistant. Use Google Search if needed to ground your answers and cite sources with [number] where relevant. Use Code execution tool only for code-related queries and complex math, do not show internal tool in response if it being used"
+            )
+
+            # Select model based on content complexity
+            model_name = select_model(request.message.content, lines)
+
+            # Stream text parts to the client as they arrive, keeping every part for the final reply
+            # Safely extract text from response, handling different response structures
+            reply_parts = []
+            finish_reason = None
+            grounded_chunk = None
+            debug_level = 0
+            try:
+                stream = await asyncio.wait_for(
+                    client.aio.models.generate_content_stream(
+                        model=model_name,
+                        contents=prompt,
+                        config=config,
+                    ),
+                    timeout=deadline - loop.time(),
+                )
+                async for chunk in iter_until(stream, deadline):
+                    if not chunk.candidates:
+                        continue
+                    debug_level = max(debug_level, 1)
+                    candidate = chunk.candidates[0]
+                    if candidate.finish_reason:
+                        finish_reason = candidate.finish_reason
+                    if getattr(candidate, "grounding_metadata", None):
+                        grounded_chunk = chunk
+                    if not (hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts')):
+                        continue
+                    debug_level = max(debug_level, 2)
+                    if not candidate.content.parts:
+                        continue
+                    debug_level = 3
+                    for kind, text in candidate_parts(candidate):
+                        reply_parts.append((kind, text))
+                        if kind == "text":
+                            yield sse_event({"delta": text})
+            except asyncio.TimeoutError:
+                yield sse_event({
+                    "response": f"Query failed: process exceeded {CHAT_TIMEOUT:g} seconds.",
+                    "title": None,
+                    "model": None
+                })
+                return
+
+            # A failed title request should not throw away a valid reply
+            if title_task is not None:
+                done, _ = await asyncio.wait({title_task}, timeout=max(0, deadline - loop.time()))
+                if title_task not in done:
+                    title_task.cancel()
+                elif title_task.exception() is None:
+                    # Sanitize: remove bullet/numbering, take only the first line, and trim to 5 words max
+                    first_line = TITLE_CLEAN.sub('', title_task.result().text or "", count=1).split('\n', 1)[0]
+                    title = ' '.join(first_line.split()[:5])
+                    async with redis_client.pipeline(transaction=True) as pipe:
+                        pipe.hset(titles_key(user_id), chat_id, title)
+                        pipe.expire(titles_key(user_id), CHAT_TTL_SECONDS)
+                        await pipe.execute()
+
+            # Show code and its output only if the final finish_reason says it is user-facing,
+            # otherwise it was internal tool use (like search)
+            content_parts = [text for kind, text in reply_parts if kind == "text" or finish_reason == "STOP"]
+            assistant_reply = "".join(content_parts)
+            debug = "123"[:debug_level]
         
-        if not assistant_reply:
-            assistant_reply = "I apologize, but I couldn't generate a proper response. Please try again.".join(debug) 
+            if not assistant_reply:
+                assistant_reply = "I apologize, but I couldn't generate a proper response. Please try again.".join(debug) 
 
-        # Wrap all code blocks in <code>...</code> tags
+            # Wrap all code blocks in <code>...</code> tags
         
         
 
-        assistant_reply = wrap_code_blocks(assistant_reply)
-        history.append(Message(role="assistant", content=assistant_reply))
-        return {
-            "response": {"role": "assistant", "content": assistant_reply},
-            "title": chat_titles.get(key),
-            "model": model_name,
-            "citation": add_citations(response)
-        }
-
+            assistant_reply = wrap_code_blocks(assistant_reply)
+            await append_message(user_id, chat_id, "assistant", assistant_reply)
+            yield sse_event({
+                "response": {"role": "assistant", "content": assistant_reply},
+                "title": title,
+                "model": model_name,
+                "citation": add_citations(grounded_chunk) if grounded_chunk else ""
+            })
+        finally:
+            # Never leave the title request orphaned when the reply fails or is abandoned
+            if title_task is not None:
+                if not title_task.done():
+                    title_task.cancel()
+                elif not title_task.cancelled():
+                    title_task.exception()
+
+    events = process_chat()
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(process_chat)
-            try:
-                result = future.result(timeout=25)
-                return result
-            except concurrent.futures.TimeoutError:
-                return {
-                    "response": "Query failed: process exceeded 25 seconds.",
-                    "title": None,
-                    "model": None
-                }
+        # Wait for the first event here so failures before streaming starts still return an error status
+        first_event = await anext(events)
     except Exception as e:
         raise HTTPException(status_code=HTTP_STATUS_INTERNAL_ERROR, detail=str(e))
 
+    async def stream_events():
+        yield first_event
+        try:
+            async for event in events:
+                yield event
+        except Exception as e:
+            yield sse_event({"error": str(e)})
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream")
+
 
 # Get all chat_ids and titles for a user
 @app.get("/user/{user_id}/chats")
-def get_chat_ids(user_id: str) -> Dict[str, List[Dict[str, str]]]:
+async def get_chat_ids(user_id: str) -> Dict[str, List[Dict[str, str]]]:
+    # Most recently used chats first
+    chat_ids = await redis_client.zrange(chats_key(user_id), 0, -1, desc=True)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(titles_key(user_id))
+        for chat_id in chat_ids:
+            pipe.exists(history_key(user_id, chat_id))
+        titles, *alive = await pipe.execute()
+    # Chats expire individually, drop ids whose history is gone from the index
+    expired = [chat_id for chat_id, exists in zip(chat_ids, alive) if not exists]
+    if expired:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zrem(chats_key(user_id), *expired)
+            pipe.hdel(titles_key(user_id), *expired)
+            await pipe.execute()
     chat_list = [
-        {"chat_id": chat_id, "title": chat_titles.get((uid, chat_id), "")}
-        for (uid, chat_id) in conversations.keys() if uid == user_id
+        {"chat_id": chat_id, "title": titles.get(chat_id, "")}
+        for chat_id, exists in zip(chat_ids, alive) if exists
     ]
     return {"chats": chat_list}
 
 # Get all messages and title for a user_id and chat_id
 @app.get("/user/{user_id}/chat/{chat_id}")
-def get_chat_history(user_id: str, chat_id: str) -> Dict[str, Any]:
-    key = (user_id, chat_id)
-    history = conversations.get(key, [])
-    messages = [{"role": m.role, "content": m.content} for m in history]
-    title = chat_titles.get(key, "")
-    return {"title": title, "messages": messages}
+async def get_chat_history(user_id: str, chat_id: str) -> Response:
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.lrange(history_key(user_id, chat_id), 0, -1)
+        pipe.hget(titles_key(user_id), chat_id)
+        history, title = await pipe.execute()
+    if history:
+        await touch_chat(user_id, chat_id)
+    # Messages are stored as JSON already, splice them into the body instead of decoding and re-encoding each one
+    body = b'{"title":' + orjson.dumps(title or "") + b',"messages":[' + ",".join(history).encode() + b"]}"
+    return Response(content=body, media_type="application/json")
 
 # Delete a specific chat conversation and title
 @app.delete("/user/{user_id}/chat/{chat_id}")
-def delete_chat(user_id: str, chat_id: str) -> Dict[str, str]:
-    """Delete a specific chat conversation and its title from memory."""
-    key = (user_id, chat_id)
-    
+async def delete_chat(user_id: str, chat_id: str) -> Dict[str, str]:
+    """Delete a specific chat conversation and its title from Redis."""
     # Check if chat exists
-    if key not in conversations:
+    if not await redis_client.exists(history_key(user_id, chat_id)):
         raise HTTPException(status_code=HTTP_STATUS_NOT_FOUND, detail="Chat not found")
     
-    # Remove conversation history
-    del conversations[key]
-    
-    # Remove chat title if it exists
-    if key in chat_titles:
-        del chat_titles[key]
+    # Remove conversation history, prompt window and title
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(history_key(user_id, chat_id), prompt_key(user_id, chat_id))
+        pipe.hdel(titles_key(user_id), chat_id)
+        pipe.zrem(chats_key(user_id), chat_id)
+        await pipe.execute()
     
     return {"message": f"Chat {chat_id} for user {user_id} has been deleted successfully"}
 